@@ -1,11 +1,30 @@
 import sys
 import asyncio
+import logging
+import logging.handlers
+import queue
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-from neji_finder_tutti_client import NejiFinderTuttiClient
+from neji_finder_tutti_client import NejiFinderTuttiClient, NejiFinderTuttiClientConnectionError
+
+logger = logging.getLogger(__name__)
+
+def setup_logging():
+    # ログの書き出しを別スレッドで行い、イベントループがstdout/stderrへの書き込みで止まらないようにする
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+    listener.start()
+    return listener
 
 async def on_response(data):
-    print('Data received! (watch_id: {})'.format(data['last_watch_id']))
-    print(data)
+    logger.info('Data received! (watch_id: %s)', data['last_watch_id'])
+    logger.info('%s', data)
 
 async def on_error(msg):
     print('on_error', msg)
@@ -54,8 +73,10 @@ async def main():
         elif mode == 'test_connection':
             print('open and sign_in finished')
 
-    except Exception as e:
+    except NejiFinderTuttiClientConnectionError as e:
         print(e.resource, e.err.state, e.err.source)
+    finally:
+        await client.close()
 
 
 if __name__=='__main__':
@@ -64,6 +85,11 @@ if __name__=='__main__':
         print('Available modes ... "publish", "watch_response"')
         print('')
     else:
-        loop = asyncio.get_event_loop()
-        loop.create_task(main())
-        loop.run_forever()
+        listener = setup_logging()
+        try:
+            if uvloop:
+                uvloop.run(main())
+            else:
+                asyncio.run(main())
+        finally:
+            listener.stop()
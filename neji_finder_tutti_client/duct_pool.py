@@ -0,0 +1,104 @@
+import asyncio
+import contextlib
+from typing import Optional, Callable
+
+from ducts_client import Duct
+
+class DuctPool:
+    '''DUCTSサーバーへの接続（Duct）をエンドポイントごとに共有するためのプールです。
+
+    同じエンドポイントに対して :meth:`acquire` が複数回呼ばれた場合は、既に開かれているDuctを参照カウント付きで共有し、
+    全ての利用者が :meth:`release` した時点で接続を切断します。
+    共有されたDuctの接続エラーは、その時点でDuctを保持している全ての利用者の ``on_error`` へ通知されます。
+    '''
+    def __init__(self):
+        self._ducts = {}
+        self._ref_counts = {}
+        self._error_listeners = {}  # wsd_url -> 利用者ごとのon_errorのリスト
+        self._locks = {}  # wsd_url -> (Lock, 待機中を含む利用者数)
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, wsd_url: str):
+        lock, users = self._locks.get(wsd_url, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[wsd_url] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[wsd_url]
+            if users == 1:
+                del self._locks[wsd_url]
+            else:
+                self._locks[wsd_url] = (lock, users - 1)
+
+    async def acquire(self, wsd_url: str, on_error: Optional[Callable] = None) -> Duct:
+        '''エンドポイントに対応するDuctを取得します。
+
+        未接続の場合はこの時点で接続します。新規に作成したDuctが接続に失敗した場合はプールに登録されません。
+        プール済みのDuctについては、再接続に失敗した場合でも参照として数えられるため、必ず :meth:`release` してください。
+
+        Args:
+            wsd_url: DUCTSサーバーへ接続するエンドポイント
+            on_error: 接続エラー時に呼ばれる（asyncコルーチン）関数。 :meth:`release` 時に同じものを渡すと登録が解除されます。
+        '''
+        async with self._lock(wsd_url):
+            duct = self._ducts.get(wsd_url)
+            if duct is None:
+                duct = Duct()
+                if on_error:
+                    duct.connection_listener.onerror = on_error
+                await duct.open(wsd_url)
+                if duct._ws is None:
+                    return duct
+
+                self._ducts[wsd_url] = duct
+                self._ref_counts[wsd_url] = 0
+                self._error_listeners[wsd_url] = []
+                duct.connection_listener.onerror = self._error_dispatcher(wsd_url)
+                self._add_holder(wsd_url, on_error)
+            else:
+                self._add_holder(wsd_url, on_error)
+                await duct.open(wsd_url)
+            return duct
+
+    def _add_holder(self, wsd_url: str, on_error: Optional[Callable]) -> None:
+        self._ref_counts[wsd_url] += 1
+        if on_error:
+            self._error_listeners[wsd_url].append(on_error)
+
+    def _error_dispatcher(self, wsd_url: str) -> Callable:
+        async def _dispatch(event):
+            for on_error in list(self._error_listeners.get(wsd_url, ())):
+                await on_error(event)
+        return _dispatch
+
+    async def release(self, duct: Duct, on_error: Optional[Callable] = None) -> None:
+        ''':meth:`acquire` で取得したDuctを返却します。
+
+        参照カウントが0になった時点で接続を切断します。プールに登録されていないDuctは即座に切断します。
+
+        Args:
+            duct: 返却するDuct
+            on_error: :meth:`acquire` 時に渡した関数
+        '''
+        wsd_url = getattr(duct, 'wsd_url', None)
+        if wsd_url is None:
+            await duct.close()
+            return
+
+        async with self._lock(wsd_url):
+            if self._ducts.get(wsd_url) is not duct:
+                await duct.close()
+                return
+
+            if on_error in self._error_listeners[wsd_url]:
+                self._error_listeners[wsd_url].remove(on_error)
+            self._ref_counts[wsd_url] -= 1
+            if self._ref_counts[wsd_url] > 0:
+                return
+            del self._ducts[wsd_url]
+            del self._ref_counts[wsd_url]
+            del self._error_listeners[wsd_url]
+            await duct.close()
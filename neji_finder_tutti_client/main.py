@@ -1,16 +1,36 @@
 import asyncio
-from typing import Optional, Tuple, Callable
+import itertools
+import time
+from typing import Optional, Tuple, List, Union, Callable
 
 from tutti_client import TuttiClient
-from ducts_client import Duct
 from .market_controller import TuttiMarketController
 
+import logging
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'NejiFinderTuttiClient',
+    'NejiFinderTuttiClientConnectionError',
+    'NejiFinderTuttiClientEnvironmentError',
+    'TuttiMarketController',
+]
+
+def _int_or_none(x):
+    if isinstance(x, int) or x is None:
+        return x
+    return int(x) if x!='' else None
+
 class NejiFinderTuttiClientConnectionError(Exception):
+    __slots__ = ('resource', 'err')
+
     def __init__(self, resource, err):
         self.resource = resource
         self.err = err
 
 class NejiFinderTuttiClientEnvironmentError(Exception):
+    __slots__ = ('err',)
+
     def __init__(self, err):
         self.err = err
 
@@ -24,6 +44,10 @@ class NejiFinderTuttiClient:
 
     これに加えて、Tutti.works、Tutti.marketへの個別の操作が必要となる場合は、それぞれ :attr:`tutti` 、 :attr:`market` メンバーから各種メソッドにアクセス可能です。
 
+    Args:
+        parameter_set_cache_ttl: :meth:`publish_tasks_to_market` が取得したAutomation Parameter Set、
+            Platform Parameter Setをキャッシュする秒数
+
     Attributes:
         tutti (`tutti_client.TuttiClient (外部リンク)`_): Tutti.worksリソースアクセス用オブジェクト
         market (TuttiMarketController): Tutti.marketリソースアクセス用オブジェクト
@@ -31,10 +55,25 @@ class NejiFinderTuttiClient:
     .. _tutti_client.TuttiClient (外部リンク):
         https://iflb.github.io/tutti-client-python/references/facade.html
     '''
-    def __init__(self):
+    __slots__ = (
+        'tutti', 'market',
+        '_parameter_set_cache_ttl', '_aps_cache', '_pps_cache',
+        '_aps_get_payload', '_pps_get_payload',
+        '_publish_seq'
+    )
+
+    def __init__(self, parameter_set_cache_ttl: float = 60):
         super()
         self.tutti = TuttiClient()
-        self.market = TuttiMarketController(Duct())
+        self.market = TuttiMarketController()
+        self._parameter_set_cache_ttl = parameter_set_cache_ttl
+        self._aps_cache = {}  # id -> (有効期限, aps)
+        self._pps_cache = {}  # id -> (有効期限, pps)
+        # TuttiMarketController.register_jobと同様に、呼び出し毎にpayloadを使い回す
+        self._aps_get_payload = { 'automation_parameter_set_id': None, 'access_token': None }
+        self._pps_get_payload = { 'platform_parameter_set_id': None, 'access_token': None }
+        # 同一秒内に発行されたタスク同士でもIDや名前が重複しないよう、タイムスタンプに付与する通し番号
+        self._publish_seq = itertools.count()
 
     async def open(self, works_host: Optional[str] = None, market_host: Optional[str] = None) -> None:
         '''Tutti.works、Tutti.marketのサーバーへ接続します。
@@ -61,13 +100,20 @@ class NejiFinderTuttiClient:
             host: Tutti.worksサーバーのホスト名
         '''
         err = []
+        err_event = asyncio.Event()
         async def on_error(event):
             err.append(event)
+            err_event.set()
 
-        if host[-1] == '/': host = host[:-1]
+        host = host.rstrip('/')
         self.tutti._duct.connection_listener.onerror = on_error
         await self.tutti.open(host + '/ducts/wsd')
-        await asyncio.sleep(0.1)
+        if self.tutti._duct._ws is None:
+            # 接続失敗時のonerrorは別タスクとして遅れて呼ばれるため、その通知を待つ
+            try:
+                await asyncio.wait_for(err_event.wait(), timeout=0.1)
+            except asyncio.TimeoutError:
+                pass
         if err:
             raise NejiFinderTuttiClientConnectionError('Tutti.works', err[0])
 
@@ -80,43 +126,53 @@ class NejiFinderTuttiClient:
             host: Tutti.marketサーバーのホスト名
         '''
         err = []
+        err_event = asyncio.Event()
         async def on_error(event):
             err.append(event)
-
-        if host[-1] == '/': host = host[:-1]
-        self.market._duct.connection_listener.onerror = on_error
-        await self.market.open(host + '/ducts/wsd')
-        await asyncio.sleep(0.1)
+            err_event.set()
+
+        host = host.rstrip('/')
+        await self.market.open(host + '/ducts/wsd', on_error)
+        if self.market._duct._ws is None:
+            # 接続失敗時のonerrorは別タスクとして遅れて呼ばれるため、その通知を待つ
+            try:
+                await asyncio.wait_for(err_event.wait(), timeout=0.1)
+            except asyncio.TimeoutError:
+                pass
         if err:
             raise NejiFinderTuttiClientConnectionError('Tutti.market', err[0])
 
-    def close(self) -> None:
+    async def close(self) -> None:
         '''Tutti.works、Tutti.marketのサーバー接続を切断します。
         '''
-        self.close_works()
-        self.close_market()
+        await asyncio.gather(self.close_works(), self.close_market())
 
-    def close_works(self) -> None:
+    async def close_works(self) -> None:
         '''Tutti.worksサーバーへの接続を切断します。
         '''
-        self.tutti.close()
+        await self.tutti._duct.close()
 
-    def close_market(self) -> None:
+    async def close_market(self) -> None:
         '''Tutti.marketサーバーへの接続を切断します。
+
+        同じTutti.marketサーバーへ接続している他のクライアントが存在する場合、接続はそれらが全て切断するまで維持されます。
         '''
-        self.market.close()
+        await self.market.close()
 
     async def sign_in(self, works_params: dict, market_params: dict) -> None:
         '''Tutti.worksおよびTutti.marketへサインインします。
 
-        内部的には、:meth:`sign_in_works` および :meth:`sign_in_market` を順に実行します。
+        内部的には、:meth:`sign_in_works` および :meth:`sign_in_market` を並行して実行します。
 
         Args:
             works_params: :meth:`sign_in_works` へ渡すキーワード引数をメンバーとして持つdict。
             market_params: :meth:`sign_in_market` へ渡すキーワード引数をメンバーとして持つdict。
         '''
-        await self.sign_in_works(**works_params)
-        await self.sign_in_market(**market_params)
+        tasks = [
+            self.sign_in_works(**works_params),
+            self.sign_in_market(**market_params),
+        ]
+        await asyncio.gather(*tasks)
 
     async def sign_in_market(self, user_id: str, password: str, access_token_lifetime: int = 60*60*24*7*1000) -> None:
         '''Tutti.marketへサインインします。
@@ -180,40 +236,28 @@ class NejiFinderTuttiClient:
 
         Returns:
             tuple: 生成されたリソースのIDを返します。0番目はTutti.worksのNanotask Group ID、1番目はTutti.marketのJob IDです。
+
+        Raises:
+            NejiFinderTuttiClientEnvironmentError: Automation Parameter Set / Platform Parameter Set が未定義またはTutti.market向けでない場合、
+                もしくはTutti.marketでのJob発行に失敗した場合。
+                例外の ``err`` 属性はdict型で、失敗した段階を示す ``stage`` （ ``'parameter_set'`` または ``'register_job'`` ）と
+                エラー内容の ``message`` を必ず持ちます。Job発行がサーバーに拒否された場合は、その応答が ``res`` に入ります。
+                Job発行時の通信エラー等は ``__cause__`` から参照できます。
         '''
 
-        data = await self.tutti._duct.call(
-                self.tutti._duct.EVENT['AUTOMATION_PARAMETER_SET_GET'],
-                {
-                    'automation_parameter_set_id': automation_parameter_set_id,
-                    'access_token': self.tutti.account_info['access_token']
-                }
-            )
-        if data and data['content']:
-            aps = data['content']
-        else:
-            raise Exception(f'Automation parameter set ID "{automation_parameter_set_id}" is not defined')
-
-        data = await self.tutti._duct.call(
-                self.tutti._duct.EVENT['PLATFORM_PARAMETER_SET_GET'],
-                {
-                    'platform_parameter_set_id': aps['platform_parameter_set_id'],
-                    'access_token': self.tutti.account_info['access_token']
-                }
-            )
-        if data:
-            pps = data['content']
-        else:
-            raise Exception('Platform parameter set ID "{}}" is not defined'.format(aps['platform_parameter_set_id']))
+        aps = await self._get_automation_parameter_set(automation_parameter_set_id)
+        pps = await self._get_platform_parameter_set(aps['platform_parameter_set_id'])
 
         if pps['platform']!='market':
-            raise Exception('Platform parameter set ID "{}" is not set for market'.format(aps['platform_parameter_set_id']))
+            raise NejiFinderTuttiClientEnvironmentError({
+                'stage': 'parameter_set',
+                'message': f'Platform parameter set ID "{aps["platform_parameter_set_id"]}" is not set for market'
+            })
 
-        import time
-        time = int(time.time())
+        label = f'{int(time.time())}-{next(self._publish_seq)}'
 
         nanotask = {
-            'id': f'{time}',
+            'id': label,
             'props': {
                 'sync_id': sync_id,
             }
@@ -228,15 +272,15 @@ class NejiFinderTuttiClient:
             num_assignable = 0,
         )
         nids = ret['nanotask_ids']
-        print('Nanotask IDs:', nids)
+        logger.debug('Nanotask IDs: %s', nids)
         ngid = await self.tutti.resource.create_nanotask_group(
-            #name = f'{student_id}-{video_id}-{time}',
-            name = f'{time}',
+            #name = f'{student_id}-{video_id}-{label}',
+            name = label,
             nanotask_ids = nids,
             project_name = aps['project_name'],
             template_name = 'NejiFinderApp',
         )
-        print('Nanotask Group ID:', ngid)
+        logger.info('Nanotask Group ID: %s', ngid)
 
         job_parameter = {
             'nanotask_group_ids': [ngid],
@@ -245,34 +289,158 @@ class NejiFinderTuttiClient:
         }
 
         try:
-            int_or_none = lambda x: int(x) if x is not None and x!='' else None
             res = await self.market.register_job(
                     job_class_id = pps['parameters']['job_class_id'],
                     job_parameter = job_parameter,
                     #description = f'Student ID: {student_id} / Video ID: {video_id}',
-                    description = f'created at {time}',
-                    num_job_assignments_max = int_or_none(pps['parameters']['num_job_assignments_max']),
-                    priority_score = int_or_none(pps['parameters']['priorityScore']),
+                    description = f'created at {label}',
+                    num_job_assignments_max = _int_or_none(pps['parameters']['num_job_assignments_max']),
+                    priority_score = _int_or_none(pps['parameters']['priorityScore']),
                 )
+        except Exception as e:
+            raise NejiFinderTuttiClientEnvironmentError({'stage': 'register_job', 'message': f'Failed to register a job: {e!r}'}) from e
+
+        if res['success']:
+            jid = res['body']
+        else:
+            raise NejiFinderTuttiClientEnvironmentError({'stage': 'register_job', 'message': 'Failed to register a job', 'res': res})
+
+        logger.debug('Job Class ID: %s', pps['parameters']['job_class_id'])
+        logger.info('Job ID: %s', jid)
+
+        return ngid, jid
 
-            if res['success']:
-                jid = res['body']
-            else:
-                raise Error('Failed to create a job')
+    async def publish_many_tasks_to_market(
+        self,
+        items: List[Tuple[str, str]],
+        max_concurrency: int = 16,
+    ) -> List[Union[Tuple[str, str], Exception]]:
+        '''複数のタスクをTutti.marketのJobとして並行に発行します。
+
+        各要素に対して :meth:`publish_tasks_to_market` を最大 :attr:`max_concurrency` 件まで同時に実行します。
+        必要なAutomation Parameter Set、Platform Parameter Setは事前に :meth:`prefetch_parameter_sets` でまとめて取得されます。
+
+        Args:
+            items: ``(automation_parameter_set_id, sync_id)`` のタプルのリスト
+            max_concurrency: 同時に発行処理を行う最大数
 
-            print('Job Class ID:', pps['parameters']['job_class_id'])
-            print('Job ID:', jid)
+        Returns:
+            list: :attr:`items` と同じ順序で、 :meth:`publish_tasks_to_market` の戻り値を返します。
+            発行に失敗した要素には、代わりに発生した例外オブジェクトが入ります。
+        '''
+        try:
+            await self.prefetch_parameter_sets([aps_id for aps_id, _ in items])
+        except Exception:
+            # 取得に失敗したIDについては、各要素の発行時に改めて例外が返される
+            pass
 
-            return ngid, jid
-        except:
-            import traceback
-            traceback.print_exc()
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _publish(automation_parameter_set_id, sync_id):
+            async with sem:
+                return await self.publish_tasks_to_market(automation_parameter_set_id, sync_id)
+
+        return await asyncio.gather(
+            *[_publish(aps_id, sync_id) for aps_id, sync_id in items],
+            return_exceptions=True
+        )
+
+    async def prefetch_parameter_sets(self, automation_parameter_set_ids: List[str]) -> None:
+        '''複数のAutomation Parameter Set、およびそれらが参照するPlatform Parameter Setを一括で取得し、キャッシュします。
+
+        未取得のものは種類ごとにまとめて並行に問い合わせるため、多数のAutomation Parameter Setに対して
+        :meth:`publish_tasks_to_market` を実行する前に呼ぶことで、問い合わせの往復を最大２回分に抑えられます。
+
+        Args:
+            automation_parameter_set_ids: Tutti.worksにおいて発行されたAutomation Parameter Set IDのリスト
+
+        Raises:
+            NejiFinderTuttiClientEnvironmentError: いずれかのParameter Setが未定義の場合。 ``err`` は
+                ``{'stage': 'parameter_set', 'message': ...}`` の形式です。この場合も、取得に成功したものはキャッシュされます。
+        '''
+        aps_ids = list(dict.fromkeys(automation_parameter_set_ids))
+        results = await asyncio.gather(
+            *[self._get_automation_parameter_set(aps_id) for aps_id in aps_ids],
+            return_exceptions=True
+        )
+        errors = [res for res in results if isinstance(res, BaseException)]
+
+        # 取得に失敗したIDがあっても、取得できたものが参照するPlatform Parameter Setは取得しておく
+        pps_ids = list(dict.fromkeys(
+            res['platform_parameter_set_id'] for res in results if not isinstance(res, BaseException)
+        ))
+        await asyncio.gather(*[self._get_platform_parameter_set(pps_id) for pps_id in pps_ids])
+
+        if errors:
+            raise errors[0]
+
+    def clear_parameter_set_cache(self, automation_parameter_set_id: Optional[str] = None) -> None:
+        '''キャッシュされたAutomation Parameter Set、Platform Parameter Setを破棄します。
+
+        Tutti.works側で設定を変更した場合、キャッシュの有効期限を待たずに反映させるために使用します。
+
+        Args:
+            automation_parameter_set_id: 指定した場合、そのAutomation Parameter Setと、それが参照するPlatform Parameter Setのみを破棄します。
+                省略した場合は全てのキャッシュを破棄します。
+        '''
+        if automation_parameter_set_id is None:
+            self._aps_cache.clear()
+            self._pps_cache.clear()
+            return
+
+        cached = self._aps_cache.pop(automation_parameter_set_id, None)
+        if cached:
+            self._pps_cache.pop(cached[1]['platform_parameter_set_id'], None)
+
+    async def _get_automation_parameter_set(self, automation_parameter_set_id: str) -> dict:
+        cached = self._aps_cache.get(automation_parameter_set_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        duct = self.tutti._duct
+        payload = self._aps_get_payload
+        payload['automation_parameter_set_id'] = automation_parameter_set_id
+        payload['access_token'] = self.tutti.account_info['access_token']
+        data = await duct.call(duct.EVENT['AUTOMATION_PARAMETER_SET_GET'], payload)
+        if data and data['content']:
+            aps = data['content']
+        else:
+            raise NejiFinderTuttiClientEnvironmentError({
+                'stage': 'parameter_set',
+                'message': f'Automation parameter set ID "{automation_parameter_set_id}" is not defined'
+            })
+
+        self._aps_cache[automation_parameter_set_id] = (time.monotonic() + self._parameter_set_cache_ttl, aps)
+        return aps
+
+    async def _get_platform_parameter_set(self, platform_parameter_set_id: str) -> dict:
+        cached = self._pps_cache.get(platform_parameter_set_id)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        duct = self.tutti._duct
+        payload = self._pps_get_payload
+        payload['platform_parameter_set_id'] = platform_parameter_set_id
+        payload['access_token'] = self.tutti.account_info['access_token']
+        data = await duct.call(duct.EVENT['PLATFORM_PARAMETER_SET_GET'], payload)
+        if data:
+            pps = data['content']
+        else:
+            raise NejiFinderTuttiClientEnvironmentError({
+                'stage': 'parameter_set',
+                'message': f'Platform parameter set ID "{platform_parameter_set_id}" is not defined'
+            })
+
+        self._pps_cache[platform_parameter_set_id] = (time.monotonic() + self._parameter_set_cache_ttl, pps)
+        return pps
 
     async def watch_responses_for_tasks(
         self,
         automation_parameter_set_id: str,
         handler: Callable[[dict], None],
-        last_watch_id: str = '+'
+        last_watch_id: str = '+',
+        queue_size: int = 256,
+        parallelism: int = 8
     ) -> None:
         '''発注したJobにおいて、Tutti.worksに保存された回答をプッシュ通知で受け取ります。
 
@@ -281,6 +449,12 @@ class NejiFinderTuttiClient:
         次回再びプロセスを呼ぶまでの間に既に発行済みのJobにおいて新たな回答があった場合に、それらの回答を次回実行時に
         まとめて取得するという目的で有効に用いることができます。
 
+        受信した回答はキューを介して :attr:`handler` へ渡されるため、 :attr:`handler` の処理が遅い場合でも受信処理は
+        妨げられません。キューが :attr:`queue_size` 件に達した場合は、空きができるまで受信を待機します。
+        :attr:`handler` は最大 :attr:`parallelism` 個まで並行して実行されるため、 ``parallelism=1`` を指定しない限り
+        :attr:`handler` の完了順は受信順と一致しません。
+        このコルーチンはキャンセルされるまで終了しません。
+
         Args:
             automation_parameter_set_id: Tutti.worksで発行されたAutomation Parameter Set ID
             handler: 回答を受信するたびに実行される（asyncコルーチン）関数。引数を１つとり、回答情報を受け取ります。
@@ -292,13 +466,58 @@ class NejiFinderTuttiClient:
                 またデフォルト値の ``+`` は正の方向の無限大値を指すため、メソッド実行時に過去の回答は返されません。
                 ``0`` を指定することで 履歴に存在する全ての回答を受け取ることが可能ですが、収集済み回答数が多く
                 なっている場合は受信データが膨大になる可能性があるため、非推奨です。
+            queue_size: 受信済みで :attr:`handler` による処理を待つ回答の最大件数
+            parallelism: 並行して実行する :attr:`handler` の最大数
         
         .. _Stream ID:
             https://redis.io/topics/streams-intro
         '''
-        self.tutti.resource.on('watch_responses_for_automation_parameter_set', handler)
-        await self.tutti.resource.watch_responses_for_automation_parameter_set.send(
-            automation_parameter_set_id = automation_parameter_set_id,
-            last_watch_id = last_watch_id,
-            exclusive = True
-        )
+        queue = asyncio.Queue(maxsize=queue_size)
+        closed = False
+
+        async def _ingress(data):
+            # on()で登録したハンドラは解除できないため、watch終了後に届いた回答は破棄する
+            if not closed:
+                await queue.put(data)
+
+        sem = asyncio.Semaphore(parallelism)
+        tasks = set()
+
+        async def _run(data):
+            try:
+                await handler(data)
+            except Exception:
+                logger.exception('Response handler raised an exception')
+            finally:
+                sem.release()
+                queue.task_done()
+
+        async def _consume():
+            try:
+                while True:
+                    data = await queue.get()
+                    await sem.acquire()
+                    task = asyncio.create_task(_run(data))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        self.tutti.resource.on('watch_responses_for_automation_parameter_set', _ingress)
+        try:
+            await self.tutti.resource.watch_responses_for_automation_parameter_set.send(
+                automation_parameter_set_id = automation_parameter_set_id,
+                last_watch_id = last_watch_id,
+                exclusive = True
+            )
+            consumer = asyncio.create_task(_consume())
+            try:
+                await consumer
+            finally:
+                consumer.cancel()
+        finally:
+            closed = True
+            # put()で待機中の_ingressがあれば、受信ループを止めないよう解放する
+            while not queue.empty():
+                queue.get_nowait()
@@ -1,29 +1,78 @@
-from typing import Optional
+from typing import Optional, Callable
 import hashlib
 
+from ducts_client import Duct
+from .duct_pool import DuctPool
+
+_default_duct_pool = DuctPool()
+
 class TuttiMarketController:
     '''Tutti.marketに関連する操作を行うオブジェクトです。
 
     現状、必要最低限のメソッド群のみを定義しています。JavaScriptにおいて既に `こちら`_ に定義された
     操作のうち、このクラスに実装が必要なものは別途問い合わせてください。
 
+    :attr:`duct` を省略した場合、接続は :class:`DuctPool` から取得されるため、同じTutti.marketサーバーへ接続する
+    複数のコントローラは１本のDUCTS接続を共有します。
+
+    Args:
+        duct: このコントローラ専用に使用するDuct。指定した場合はプールを使用しません。
+        duct_pool: 接続の取得元。省略した場合はモジュール共通のプールを使用します。
+
     .. _こちら:
         https://github.com/iflb/tutti-market/blob/a4b6b9054183f761a1692ff9633a84e80d93ea3c/frontend/src/scripts/ducts.js#L142
     '''
-    def __init__(self, duct):
+    __slots__ = ('_duct_pool', '_duct', '_on_error', 'access_token', '_register_job_payload')
+
+    def __init__(self, duct: Optional[Duct] = None, *, duct_pool: Optional[DuctPool] = None):
+        self._duct_pool = None if duct is not None else (duct_pool or _default_duct_pool)
         self._duct = duct
+        self._on_error = None
+        # Duct.call()はawait直後、最初の中断点より前にpayloadをmsgpackへ直列化するため、使い回しても安全
+        self._register_job_payload = {
+            'access_token': None,
+            'job_class_id': None,
+            'job_parameter': None,
+            'description': None,
+            'num_job_assignments_max': None,
+            'priority_score': None
+        }
 
-    async def open(self, wsd_url: str):
+    async def open(self, wsd_url: str, on_error: Optional[Callable] = None):
         '''Tutti.marketサーバーへ接続します。
 
+        既に接続済みの場合は、それまでの接続を返却してから接続し直します。
+
         Args:
             wsd_url: DUCTSサーバーへ接続するエンドポイント
+            on_error: 接続エラー時に呼ばれる（asyncコルーチン）関数
         '''
-        await self._duct.open(wsd_url)
+        if self._duct_pool is None:
+            if on_error:
+                self._duct.connection_listener.onerror = on_error
+            await self._duct.open(wsd_url)
+            return
+
+        duct = await self._duct_pool.acquire(wsd_url, on_error)
+        prev_duct, self._duct = self._duct, duct
+        prev_on_error, self._on_error = self._on_error, on_error
+        if prev_duct is not None:
+            await self._duct_pool.release(prev_duct, prev_on_error)
 
     async def close(self):
-        '''Tutti.marketサーバーとの接続を切断します。'''
-        await self._duct.close()
+        '''Tutti.marketサーバーとの接続を切断します。
+
+        同じTutti.marketサーバーへ接続している他のコントローラが存在する場合、接続はそれらが全て切断するまで維持されます。
+        '''
+        if self._duct_pool is None:
+            await self._duct.close()
+            return
+
+        if self._duct is None:
+            return
+        duct, self._duct = self._duct, None
+        on_error, self._on_error = self._on_error, None
+        await self._duct_pool.release(duct, on_error)
 
     async def register_job(
         self,
@@ -42,22 +91,23 @@ class TuttiMarketController:
             num_job_assignments_max: 収集する回答数上限
             priority_score: 優先度。値が小さいほど優先度が高く、優先的にワーカーへ割り当てられます。
         '''
-        data = await self._duct.call(self._duct.EVENT['REGISTER_JOB'], {
-                'access_token': self.access_token,
-                'job_class_id': job_class_id,
-                'job_parameter': job_parameter,
-                'description': description,
-                'num_job_assignments_max': num_job_assignments_max,
-                'priority_score': priority_score
-            })
+        payload = self._register_job_payload
+        payload['access_token'] = self.access_token
+        payload['job_class_id'] = job_class_id
+        payload['job_parameter'] = job_parameter
+        payload['description'] = description
+        payload['num_job_assignments_max'] = num_job_assignments_max
+        payload['priority_score'] = priority_score
+        data = await self._duct.call(self._duct.EVENT['REGISTER_JOB'], payload)
         return data
 
     async def sign_in(self, user_id: str, password: str, access_token_lifetime: int):
         '''Tutti.marketにサインインします。
         '''
+        # DUCTSはpayloadをmsgpackで送信するため、digestはbytesのまま（hex/base64化せず）渡す
         data = await self._duct.call(self._duct.EVENT['SIGN_IN'], {
             'user_id': user_id,
-            'password_hash': hashlib.sha512(password.encode('ascii')).digest(),
+            'password_hash': hashlib.sha512(password.encode('utf-8')).digest(),
             'access_token_lifetime': access_token_lifetime
         })
         self.access_token = data['body']['access_token']
@@ -140,7 +140,7 @@ setup(
     # and refuse to install the project if the version does not match. If you
     # do not support Python 2, you can simplify this to '>=3.5' or similar, see
     # https://packaging.python.org/guides/distributing-packages-using-setuptools/#python-requires
-    python_requires='>=3.6',
+    python_requires='>=3.8',
 
     # This field lists other packages that your project depends on to run.
     # Any package you put here will be installed by pip when your project is
@@ -163,6 +163,7 @@ setup(
     extras_require={  # Optional
         #'dev': ['check-manifest'],
         #'test': ['coverage'],
+        'uvloop': ['uvloop>=0.18; sys_platform != "win32"'],
     },
 
     # If there are data files included in your packages that need to be